@@ -4,11 +4,13 @@ FastAPI backend for Confluence RAG
 - Azure AI Search (vector + semantic reranker)
 - Azure OpenAI chat + embeddings
 - Compatible with azure-search-documents 11.6.x
+- Fully async: outbound calls don't hold a worker thread
 """
 
 import os
 import logging
 from typing import List
+import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -16,10 +18,10 @@ from dotenv import load_dotenv
 
 # Azure Search
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 
 # Azure OpenAI
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI
 
 # --------------------------------------------------
 # ENV
@@ -45,10 +47,18 @@ search_client = SearchClient(
     AzureKeyCredential(AZURE_SEARCH_KEY),
 )
 
-aoai = AzureOpenAI(
+# One HTTP/2 connection pool shared by embedding and chat calls
+aoai_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    timeout=60,
+)
+
+aoai = AsyncAzureOpenAI(
     api_key=AZURE_OPENAI_KEY,
     azure_endpoint=AZURE_OPENAI_ENDPOINT,
     api_version="2024-02-15-preview",  # ✅ Updated to match ingestion
+    http_client=aoai_http,
 )
 
 # --------------------------------------------------
@@ -75,22 +85,22 @@ class QueryResponse(BaseModel):
 # --------------------------------------------------
 # HELPERS
 # --------------------------------------------------
-def embed_query(text: str) -> List[float]:
+async def embed_query(text: str) -> List[float]:
     """Generate embedding for query text"""
-    resp = aoai.embeddings.create(
+    resp = await aoai.embeddings.create(
         model=EMBED_DEPLOYMENT,
         input=text,
     )
     return resp.data[0].embedding
 
-def retrieve(query: str):
+async def retrieve(query: str):
     """
     Retrieve relevant documents using hybrid search (vector + semantic)
     Returns top 6 unique Confluence pages
     """
-    query_vector = embed_query(query)
+    query_vector = await embed_query(query)
     
-    results = search_client.search(
+    results = await search_client.search(
         search_text=query,
         vector_queries=[{
             "kind": "vector",
@@ -107,7 +117,7 @@ def retrieve(query: str):
     seen_pages = {}
     all_chunks = []
     
-    for r in results:
+    async for r in results:
         page_id = r.get("page_id")
         title = r.get("title", "Untitled")
         content = r.get("content", "")
@@ -134,7 +144,7 @@ def retrieve(query: str):
     
     return all_chunks, list(seen_pages.values())
 
-def generate_answer(query: str, docs: List[dict]) -> str:
+async def generate_answer(query: str, docs: List[dict]) -> str:
     """Generate answer using Azure OpenAI with retrieved context"""
     if not docs:
         return "I could not find relevant information in Confluence."
@@ -152,7 +162,7 @@ def generate_answer(query: str, docs: List[dict]) -> str:
         "Be concise and accurate."
     )
     
-    resp = aoai.chat.completions.create(
+    resp = await aoai.chat.completions.create(
         model=CHAT_DEPLOYMENT,
         temperature=0,
         messages=[
@@ -169,8 +179,13 @@ def generate_answer(query: str, docs: List[dict]) -> str:
 # --------------------------------------------------
 # API ENDPOINTS
 # --------------------------------------------------
+@app.on_event("shutdown")
+async def close_clients():
+    await search_client.close()
+    await aoai.close()
+
 @app.post("/query", response_model=QueryResponse)
-def query_rag(req: QueryRequest):
+async def query_rag(req: QueryRequest):
     """
     Main RAG endpoint
     - Retrieves relevant documents from Azure AI Search
@@ -179,10 +194,10 @@ def query_rag(req: QueryRequest):
     """
     try:
         # Retrieve documents (all chunks + unique pages)
-        all_chunks, unique_pages = retrieve(req.query)
+        all_chunks, unique_pages = await retrieve(req.query)
         
         # Generate answer using all relevant chunks
-        answer = generate_answer(req.query, all_chunks)
+        answer = await generate_answer(req.query, all_chunks)
         
         # Return unique pages as sources (top 6)
         return QueryResponse(answer=answer, sources=unique_pages)
@@ -4,8 +4,13 @@ load_dotenv()
 import os
 import json
 import hashlib
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from selectolax.lexbor import LexborHTMLParser
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
@@ -15,6 +20,7 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     HnswAlgorithmConfiguration,
     VectorSearchProfile,
+    ScalarQuantizationCompression,
 )
 from azure.core.credentials import AzureKeyCredential
 from openai import AzureOpenAI
@@ -52,11 +58,19 @@ AOAI_EMBED_DEPLOYMENT = os.environ["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"]
 
 SSL_CERT_PATH = os.getenv("SSL_CERT_PATH", "confluence.crt")
 STATE_FILE = "confluence_state.json"
+# Bumped when the indexed chunk text changes (2: plain text instead of storage XHTML);
+# a state file from another format is discarded so every page is re-indexed once
+STATE_FORMAT = 2
+DEBUG_STATE = os.getenv("DEBUG_STATE") == "1"
 CHUNK_MAX_CHARS = int(os.getenv("CHUNK_MAX_CHARS", "3000"))
 CHUNK_OVERLAP_CHARS = int(os.getenv("CHUNK_OVERLAP_CHARS", "400"))
-BATCH_SIZE = int(os.getenv("BATCH_SIZE", "8"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "16"))
+EMBED_MAX_TOKENS = int(os.getenv("EMBED_MAX_TOKENS", "8191"))
 VECTOR_DIMENSIONS = int(os.getenv("VECTOR_DIMENSIONS", "1536"))
 MAX_PAGES = int(os.getenv("MAX_PAGES", "500"))
+WORKERS = int(os.getenv("WORKERS", "10"))
+# Listing requests in flight against the Confluence host at once
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
 
 # ============================================================
 # Clients
@@ -65,8 +79,22 @@ aoai = AzureOpenAI(
     api_key=AOAI_KEY,
     azure_endpoint=AOAI_ENDPOINT,
     api_version="2024-02-15-preview",
+    max_retries=3,
 )
 
+# Keep-alive session for Confluence; retries throttled/failed calls with backoff
+confluence = requests.Session()
+confluence.auth = (CONFLUENCE_USERNAME, CONFLUENCE_API_TOKEN)
+confluence.headers.update({"Accept-Encoding": "gzip"})
+confluence.verify = SSL_CERT_PATH if os.path.exists(SSL_CERT_PATH) else True
+_adapter = HTTPAdapter(
+    pool_maxsize=max(WORKERS, FETCH_CONCURRENCY),
+    # Retry honors Retry-After on 429/503, which throttles all listing threads
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+)
+confluence.mount("https://", _adapter)
+confluence.mount("http://", _adapter)
+
 index_client = SearchIndexClient(
     SEARCH_ENDPOINT,
     AzureKeyCredential(SEARCH_KEY),
@@ -84,86 +112,110 @@ search_client = SearchClient(
 def load_state():
     if os.path.exists(STATE_FILE):
         with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+            state = json.load(f)
+        if state.pop("_format", 1) == STATE_FORMAT:
+            return state
+        print(f"♻️ State file predates chunk format {STATE_FORMAT}; re-indexing all pages")
     return {}
 
 def save_state(state):
+    state = {"_format": STATE_FORMAT, **state}
     with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2)
+        if DEBUG_STATE:
+            json.dump(state, f, indent=2)
+        else:
+            json.dump(state, f, separators=(",", ":"))
+
+def storage_to_text(storage_html: str) -> str:
+    """Strip Confluence storage XHTML down to its text (entities decoded by the parser)"""
+    body = LexborHTMLParser(storage_html).body
+    if body is None:
+        return ""
+    return " ".join(body.text(separator=" ").split())
 
 def chunk_text(text: str) -> List[str]:
-    chunks = []
-    start = 0
-    length = len(text)
-    while start < length:
-        end = start + CHUNK_MAX_CHARS
-        chunks.append(text[start:end])
-        start = end - CHUNK_OVERLAP_CHARS
-        if start < 0:
-            start = 0
-    return chunks
+    if CHUNK_OVERLAP_CHARS >= CHUNK_MAX_CHARS:
+        raise ValueError("CHUNK_OVERLAP_CHARS must be less than CHUNK_MAX_CHARS")
+    # One slice per start offset; no per-chunk loop bookkeeping
+    step = CHUNK_MAX_CHARS - CHUNK_OVERLAP_CHARS
+    return [text[start : start + CHUNK_MAX_CHARS] for start in range(0, len(text), step)]
+
+def embedding_batches(texts: List[str]):
+    """Yield batches of at most BATCH_SIZE texts and roughly EMBED_MAX_TOKENS tokens"""
+    batch, tokens = [], 0
+    for text in texts:
+        text_tokens = len(text) // 4
+        if batch and (len(batch) >= BATCH_SIZE or tokens + text_tokens > EMBED_MAX_TOKENS):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(text)
+        tokens += text_tokens
+    if batch:
+        yield batch
+
+def embed_batch(n: int, batch: List[str]) -> List[List[float]]:
+    print(f"🧠 Embedding batch {n} ({len(batch)} chunks)")
+    resp = aoai.embeddings.create(
+        model=AOAI_EMBED_DEPLOYMENT,
+        input=batch,
+        timeout=60,
+    )
+    return [d.embedding for d in resp.data]
 
 def embed_texts(texts: List[str]) -> List[List[float]]:
+    # Batches are sent concurrently; map() keeps results in input order
+    batches = list(embedding_batches(texts))
     vectors = []
-    for i in range(0, len(texts), BATCH_SIZE):
-        batch = texts[i : i + BATCH_SIZE]
-        print(f"🧠 Embedding batch {i // BATCH_SIZE + 1} ({len(batch)} chunks)")
-        resp = aoai.embeddings.create(
-            model=AOAI_EMBED_DEPLOYMENT,
-            input=batch,
-            timeout=60,
-        )
-        vectors.extend([d.embedding for d in resp.data])
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for batch_vectors in executor.map(embed_batch, range(1, len(batches) + 1), batches):
+            vectors.extend(batch_vectors)
     return vectors
 
 # ============================================================
 # Confluence Fetch (SPACE-SCOPED)
 # ============================================================
+def fetch_page_batch(start: int, limit: int = 50) -> dict:
+    print(f"➡️ Fetching pages {start}-{start + limit - 1}")
+    resp = confluence.get(
+        f"{CONFLUENCE_BASE_URL}/rest/api/content",
+        params={
+            "spaceKey": CONFLUENCE_SPACE_KEY,
+            "start": start,
+            "limit": limit,
+            "expand": "body.storage,version",
+            "type": "page",
+        },
+        timeout=30,
+    )
+    resp.raise_for_status()
+    return orjson.loads(resp.content)
+
 def fetch_pages():
     print(f"📥 Fetching pages from Confluence space '{CONFLUENCE_SPACE_KEY}'")
-    url = f"{CONFLUENCE_BASE_URL}/rest/api/content"
-    params = {
-        "spaceKey": CONFLUENCE_SPACE_KEY,
-        "limit": 50,
-        "expand": "body.storage,version",
-        "type": "page",
-    }
-    
-    pages = []
-    page_count = 0
+    first = fetch_page_batch(0)
+    pages = first.get("results", [])
+    # The server may return fewer pages per request than asked for
+    limit = first.get("limit") or 50
+    if len(pages) < limit:
+        return pages
     
-    # Check if SSL cert exists
-    verify_ssl = SSL_CERT_PATH if os.path.exists(SSL_CERT_PATH) else True
-    
-    while True:
-        page_count += 1
-        if page_count > MAX_PAGES:
-            print("⚠️ Max page limit reached, stopping pagination")
-            break
-        
-        print(f"➡️ Fetching: {url}")
-        resp = requests.get(
-            url,
-            params=params,
-            auth=(CONFLUENCE_USERNAME, CONFLUENCE_API_TOKEN),
-            verify=verify_ssl,
-            timeout=30,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        
-        batch = data.get("results", [])
-        pages.extend(batch)
-        print(f"📄 Pages fetched so far: {len(pages)}")
-        
-        next_link = data.get("_links", {}).get("next")
-        if not next_link:
-            break
-        
-        url = CONFLUENCE_BASE_URL + next_link
-        params = None  # next already includes params
-    
-    return pages
+    # Request offsets FETCH_CONCURRENCY at a time until a short batch comes back
+    page_count = 1
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        while True:
+            wave = min(FETCH_CONCURRENCY, MAX_PAGES - page_count)
+            if wave <= 0:
+                print("⚠️ Max page limit reached, stopping pagination")
+                return pages
+            offsets = [(page_count + n) * limit for n in range(wave)]
+            page_count += wave
+            for data in executor.map(lambda start: fetch_page_batch(start, limit), offsets):
+                batch = data.get("results", [])
+                pages.extend(batch)
+                if len(batch) < limit:
+                    print(f"📄 Pages fetched: {len(pages)}")
+                    return pages
+            print(f"📄 Pages fetched so far: {len(pages)}")
 
 # ============================================================
 # Index (vector-only, SDK-safe)
@@ -193,14 +245,18 @@ def ensure_index():
         ),
     ]
     
+    # int8 scalar quantization keeps the HNSW graph at a quarter of the float32 size;
+    # full-precision vectors stay stored so ingest can reuse them
     vector_search = VectorSearch(
         algorithms=[HnswAlgorithmConfiguration(name="hnsw")],
         profiles=[
             VectorSearchProfile(
                 name="vector-profile",
                 algorithm_configuration_name="hnsw",
+                compression_name="sq-int8",
             )
         ],
+        compressions=[ScalarQuantizationCompression(compression_name="sq-int8")],
     )
     
     index = SearchIndex(
@@ -212,6 +268,35 @@ def ensure_index():
     index_client.create_index(index)
     print("✅ Index created")
 
+def chunk_hash(chunk: str) -> str:
+    return hashlib.blake2b(chunk.encode(), digest_size=16).hexdigest()
+
+def indexed_chunks(page_ids: List[str]):
+    """
+    Return (chunk hash -> vector, ids) for the chunks currently indexed for these pages
+    """
+    vectors, ids = {}, set()
+    for i in range(0, len(page_ids), 500):
+        group = ",".join(page_ids[i : i + 500])
+        results = search_client.search(
+            search_text="*",
+            filter=f"search.in(page_id, '{group}', ',')",
+            select=["id", "content", "content_vector"],
+            top=100000,
+        )
+        for r in results:
+            vectors[chunk_hash(r["content"])] = r["content_vector"]
+            ids.add(r["id"])
+    return vectors, ids
+
+def upload_batch(batch: List[dict]) -> List[dict]:
+    search_client.upload_documents(batch)
+    return batch
+
+def delete_batch(batch: List[str]) -> List[str]:
+    search_client.delete_documents([{"id": doc_id} for doc_id in batch])
+    return batch
+
 # ============================================================
 # Main
 # ============================================================
@@ -223,12 +308,12 @@ def run():
     pages = fetch_pages()
     
     docs_to_upload = []
+    changed_pages = []
     
     for page in pages:
         page_id = page["id"]
         version = page["version"]["number"]
         title = page["title"]
-        content = page["body"]["storage"]["value"]
         
         # ✅ FIXED: Correct URL construction (no duplicate /wiki)
         base = CONFLUENCE_BASE_URL.rstrip("/")
@@ -245,11 +330,27 @@ def run():
             print(" ↳ Skipped (unchanged)")
             continue
         
-        chunks = chunk_text(content)
-        vectors = embed_texts(chunks)
-        
+        # Only changed pages are parsed
+        content = storage_to_text(page["body"]["storage"]["value"])
+        changed_pages.append((page_id, version, title, page_url, chunk_text(content)))
+    
+    # Reuse vectors of chunks whose text is already indexed; embed the rest together
+    # so requests carry full batches
+    all_chunks = [chunk for *_, chunks in changed_pages for chunk in chunks]
+    hashes = [chunk_hash(chunk) for chunk in all_chunks]
+    vector_by_hash, indexed_ids = indexed_chunks([page_id for page_id, *_ in changed_pages])
+    missing = {h: chunk for h, chunk in zip(hashes, all_chunks) if h not in vector_by_hash}
+    print(f"♻️ Embedding {len(missing)} new chunks ({len(all_chunks) - len(missing)} reused)")
+    vector_by_hash.update(zip(missing, embed_texts(list(missing.values()))))
+    vectors = (vector_by_hash[h] for h in hashes)
+    
+    for page_id, version, title, page_url, chunks in changed_pages:
+        # Hash the page prefix once; each chunk id only adds its index to a copy
+        id_hasher = hashlib.sha1(f"{page_id}-".encode())
         for i, (chunk, vector) in enumerate(zip(chunks, vectors)):
-            doc_id = hashlib.sha1(f"{page_id}-{i}".encode()).hexdigest()
+            h = id_hasher.copy()
+            h.update(b"%d" % i)
+            doc_id = h.hexdigest()
             docs_to_upload.append({
                 "id": doc_id,
                 "page_id": page_id,
@@ -262,10 +363,22 @@ def run():
         state[page_id] = version
     
     print(f"📤 Uploading {len(docs_to_upload)} documents")
-    for i in range(0, len(docs_to_upload), 500):
-        batch = docs_to_upload[i : i + 500]
-        search_client.upload_documents(batch)
-        print(f" ↳ Uploaded {i + len(batch)}")
+    batches = [docs_to_upload[i : i + 500] for i in range(0, len(docs_to_upload), 500)]
+    uploaded = 0
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        for batch in executor.map(upload_batch, batches):
+            uploaded += len(batch)
+            print(f" ↳ Uploaded {uploaded}")
+    
+    # Changed pages may now have fewer chunks (or chunks from an older format);
+    # ids that were not overwritten above are removed
+    stale_ids = sorted(indexed_ids - {doc["id"] for doc in docs_to_upload})
+    if stale_ids:
+        print(f"🧹 Deleting {len(stale_ids)} stale chunks")
+        batches = [stale_ids[i : i + 500] for i in range(0, len(stale_ids), 500)]
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            for _ in executor.map(delete_batch, batches):
+                pass
     
     save_state(state)
     print("✅ Ingestion complete")
@@ -8,7 +8,7 @@ endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
 key = os.getenv("AZURE_SEARCH_KEY")
 index_name = os.getenv("AZURE_SEARCH_INDEX")
 
-url = f"{endpoint}/indexes/{index_name}?api-version=2023-11-01"
+url = f"{endpoint}/indexes/{index_name}?api-version=2024-07-01"
 headers = {
     "Content-Type": "application/json",
     "api-key": key
@@ -31,14 +31,14 @@ index_payload = {
             "type": "Collection(Edm.Single)",
             "searchable": True,
             "dimensions": 1536,
-            "vectorSearchConfiguration": "default"
+            "vectorSearchProfile": "default-profile"
         },
         {"name": "url", "type": "Edm.String", "filterable": True},
         {"name": "space", "type": "Edm.String", "filterable": True},
         {"name": "parent_id", "type": "Edm.String", "filterable": True}
     ],
     "vectorSearch": {
-        "algorithmConfigurations": [
+        "algorithms": [
             {
                 "name": "default",
                 "kind": "hnsw",
@@ -49,6 +49,17 @@ index_payload = {
                     "efSearch": 500
                 }
             }
+        ],
+        "profiles": [
+            {"name": "default-profile", "algorithm": "default", "compression": "sq-int8"}
+        ],
+        # Vectors are quantized to int8 in the index, a quarter of the float32 size
+        "compressions": [
+            {
+                "name": "sq-int8",
+                "kind": "scalarQuantization",
+                "scalarQuantizationParameters": {"quantizedDataType": "int8"}
+            }
         ]
     }
 }
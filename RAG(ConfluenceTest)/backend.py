@@ -5,15 +5,17 @@ Enhanced with strict knowledge base adherence
 
 import os
 import re
+import orjson
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List
 from dotenv import load_dotenv
 load_dotenv()
 
-from openai import AzureOpenAI
-from azure.search.documents import SearchClient
+from openai import AsyncAzureOpenAI
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import VectorizedQuery
 from azure.core.credentials import AzureKeyCredential
 
@@ -26,6 +28,9 @@ CHAT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT")
 AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
 SPACE_KEY = os.getenv("CONFLUENCE_SPACE_KEY")
+# Built once; quotes in the key are doubled per OData string literal rules
+_ODATA_QUOTES = str.maketrans({"'": "''"})
+SPACE_FILTER = f"space eq '{SPACE_KEY.translate(_ODATA_QUOTES)}'" if SPACE_KEY else None
 
 # validate
 for name, val in [
@@ -39,8 +44,8 @@ for name, val in [
     if not val:
         raise RuntimeError(f"Missing env var {name}")
 
-# Azure OpenAI client
-client = AzureOpenAI(
+# Async clients, so waiting on Azure doesn't hold a worker thread
+client = AsyncAzureOpenAI(
     api_key=AZURE_OPENAI_KEY,
     api_version="2023-05-15",
     azure_endpoint=AZURE_OPENAI_ENDPOINT
@@ -67,29 +72,22 @@ class QueryReq(BaseModel):
     query: str
     top_k: int = 5
 
+# Outdated-page markers, compiled once into a single alternation
+_OUTDATED_RE = re.compile(
+    r'\b(?:outdated|archived|legacy|old)\s+version\b'
+    r'|\bdeprecated\b'
+    r'|\bno\s+longer\s+valid\b'
+    r'|\bsuperseded\b'
+    r'|\bobsolete\b'
+    r'|\[\s*(?:outdated|deprecated|archived)\s*\]',
+    re.IGNORECASE
+)
+_WORD_RE = re.compile(r'\w+')
+
 def is_outdated_page(title: str, content: str) -> bool:
     """Check if a page is marked as outdated"""
-    outdated_patterns = [
-        r'\boutdated\s+version\b',
-        r'\barchived\s+version\b',
-        r'\blegacy\s+version\b',
-        r'\bdeprecated\b',
-        r'\bno\s+longer\s+valid\b',
-        r'\bold\s+version\b',
-        r'\bsuperseded\b',
-        r'\bobsolete\b',
-        r'\[\s*outdated\s*\]',
-        r'\[\s*deprecated\s*\]',
-        r'\[\s*archived\s*\]'
-    ]
-    
     text_to_check = f"{title} {content[:500]}".lower()
-    
-    for pattern in outdated_patterns:
-        if re.search(pattern, text_to_check, re.IGNORECASE):
-            return True
-    
-    return False
+    return _OUTDATED_RE.search(text_to_check) is not None
 
 def rerank_results(query: str, results: List[dict]) -> List[dict]:
     """Rerank results based on relevance"""
@@ -98,14 +96,14 @@ def rerank_results(query: str, results: List[dict]) -> List[dict]:
     
     scored_results = []
     query_lower = query.lower()
-    query_terms = set(re.findall(r'\w+', query_lower))
+    query_terms = set(_WORD_RE.findall(query_lower))
     
     for result in results:
         content = result.get('content', '').lower()
         title = result.get('title', '').lower()
         
-        content_terms = set(re.findall(r'\w+', content))
-        title_terms = set(re.findall(r'\w+', title))
+        content_terms = set(_WORD_RE.findall(content))
+        title_terms = set(_WORD_RE.findall(title))
         
         content_overlap = len(query_terms & content_terms) / max(len(query_terms), 1)
         title_overlap = len(query_terms & title_terms) / max(len(query_terms), 1)
@@ -116,22 +114,24 @@ def rerank_results(query: str, results: List[dict]) -> List[dict]:
     scored_results.sort(reverse=True, key=lambda x: x[0])
     return [result for _, result in scored_results]
 
-@app.post("/api/query")
-def query_endpoint(req: QueryReq):
+async def build_rag_context(req: QueryReq):
+    """Retrieve sources for a query and build the grounded chat messages"""
     q = req.query
     k = min(req.top_k if req.top_k and req.top_k > 0 else 5, 15)  # Increased to 15 for better coverage
 
     # 1) Embed the query directly (no expansion to keep it focused)
-    q_emb = client.embeddings.create(model=EMBED_DEPLOYMENT, input=q).data[0].embedding
+    q_emb = (await client.embeddings.create(model=EMBED_DEPLOYMENT, input=q)).data[0].embedding
 
-    # 2) Vector search with higher k to account for filtering
+    # 2) Hybrid search (keyword + vector, fused by the service in one request)
+    #    with higher k to account for filtering
     search_k = min(k * 3, 45)  # Increased for better recall
     vector_query = VectorizedQuery(vector=q_emb, k_nearest_neighbors=search_k, fields="vector")
-    results = search_client.search(
-        search_text="",
+    results = await search_client.search(
+        search_text=q,
         vector_queries=[vector_query],
+        top=search_k,
         select=["id", "title", "content", "url", "page_id", "last_modified", "has_video"],
-        filter=f"space eq '{SPACE_KEY}'" if SPACE_KEY else None
+        filter=SPACE_FILTER
     )
 
     # 3) Deduplicate, filter outdated pages
@@ -139,7 +139,7 @@ def query_endpoint(req: QueryReq):
     seen_pages = set()
     filtered_count = 0
     
-    for r in results:
+    async for r in results:
         page_id = r.get("page_id")
         title = r.get("title", "")
         content = r.get("content", "")
@@ -217,15 +217,31 @@ Provide your answer based STRICTLY on the sources above:"""
         {"role": "user", "content": user_prompt}
     ]
 
+    return messages, hits, filtered_count
+
+# Generation settings with strict grounding
+CHAT_OPTIONS = {
+    "max_tokens": 1000,  # Increased for detailed answers
+    "temperature": 0.0,   # Zero temperature for factual accuracy
+    "top_p": 1.0,
+    "frequency_penalty": 0.0,
+    "presence_penalty": 0.0
+}
+
+@app.on_event("shutdown")
+async def close_clients():
+    await search_client.close()
+    await client.close()
+
+@app.post("/api/query")
+async def query_endpoint(req: QueryReq):
+    messages, hits, filtered_count = await build_rag_context(req)
+
     # 6) Generate response with strict grounding
-    chat_resp = client.chat.completions.create(
+    chat_resp = await client.chat.completions.create(
         model=CHAT_DEPLOYMENT,
         messages=messages,
-        max_tokens=1000,  # Increased for detailed answers
-        temperature=0.0,   # Zero temperature for factual accuracy
-        top_p=1.0,
-        frequency_penalty=0.0,
-        presence_penalty=0.0
+        **CHAT_OPTIONS
     )
 
     assistant_text = chat_resp.choices[0].message.content
@@ -239,6 +255,39 @@ Provide your answer based STRICTLY on the sources above:"""
         }
     }
 
+def sse(payload: dict) -> bytes:
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+@app.post("/api/query_stream")
+async def query_stream_endpoint(req: QueryReq):
+    """
+    Same as /api/query, but streams the answer as Server-Sent Events:
+    one "sources" event, then "token" events as the model generates, then "done".
+    """
+    messages, hits, filtered_count = await build_rag_context(req)
+
+    async def events():
+        yield sse({"type": "sources", "sources": hits})
+        stream = await client.chat.completions.create(
+            model=CHAT_DEPLOYMENT,
+            messages=messages,
+            stream=True,
+            **CHAT_OPTIONS
+        )
+        async for chunk in stream:
+            # Azure sends an initial chunk with no choices (content filter results)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield sse({"type": "token", "text": chunk.choices[0].delta.content})
+        yield sse({
+            "type": "done",
+            "metadata": {
+                "filtered_outdated_pages": filtered_count,
+                "total_sources_used": len(hits)
+            }
+        })
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/health")
 def health_check():
     return {"status": "healthy", "service": "Confluence Knowledge Base API"}
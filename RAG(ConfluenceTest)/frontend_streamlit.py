@@ -4,12 +4,19 @@ Streamlit chatbot frontend - Professional Design
 
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import orjson
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 API_URL = os.getenv("API_URL", "http://localhost:8000")
+ANSWER_CACHE_TTL = 600  # seconds
+ANSWER_CACHE_MAX_ENTRIES = 256
+STREAM_FLUSH_INTERVAL = 0.05  # ~20 UI updates per second while streaming
 
 # Page config
 st.set_page_config(
@@ -19,8 +26,81 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# Custom CSS
-st.markdown("""
+# Shared HTTP session (keeps connections to the API alive across reruns)
+@st.cache_resource
+def http() -> requests.Session:
+    s = requests.Session()
+    s.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+    return s
+
+# Completed answers shared across sessions, so repeating the same question skips the backend
+@st.cache_resource
+def answer_cache() -> dict:
+    return {}
+
+@st.cache_resource
+def answer_cache_lock() -> threading.Lock:
+    return threading.Lock()
+
+def cached_answer(query: str, top_k: int):
+    entry = answer_cache().get((query, top_k))
+    if entry and time.time() - entry[0] < ANSWER_CACHE_TTL:
+        return entry[1]
+    return None
+
+def store_answer(query: str, top_k: int, data: dict):
+    """Cache an answer, dropping expired entries and the oldest ones beyond the size cap"""
+    cache = answer_cache()
+    now = time.time()
+    with answer_cache_lock():
+        cache.pop((query, top_k), None)
+        cache[(query, top_k)] = (now, data)
+        # Entries are kept in insertion order, so the oldest come first
+        for key in list(cache):
+            if len(cache) <= ANSWER_CACHE_MAX_ENTRIES and now - cache[key][0] < ANSWER_CACHE_TTL:
+                break
+            del cache[key]
+
+def stream_answer(query: str, top_k: int, result: dict):
+    """Yield answer text from /api/query_stream, batching tokens between UI updates"""
+    pending = []
+    last_flush = time.monotonic()
+    with http().post(
+        f"{API_URL}/api/query_stream",
+        json={"query": query, "top_k": top_k},
+        stream=True,
+        timeout=60
+    ) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            if not line.startswith(b"data:"):
+                continue
+            event = orjson.loads(line[5:])
+            if event["type"] == "sources":
+                result["sources"] = event["sources"]
+            elif event["type"] == "token":
+                pending.append(event["text"])
+                if time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL:
+                    yield "".join(pending)
+                    pending = []
+                    last_flush = time.monotonic()
+    if pending:
+        yield "".join(pending)
+
+def preview_text(content: str) -> str:
+    return content[:180] + "..." if len(content) > 180 else content
+
+def history_source(src: dict) -> dict:
+    """Keep a short preview instead of the full chunk content in session state"""
+    stored = {k: v for k, v in src.items() if k != "content"}
+    stored["preview"] = preview_text(src.get("content", ""))
+    return stored
+
+# Custom CSS (built once per process and reused on every rerun)
+@st.cache_resource
+def _css_blob() -> str:
+    return """
 <style>
     /* Main container */
     .main {
@@ -250,7 +330,9 @@ st.markdown("""
         text-decoration: underline;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(_css_blob(), unsafe_allow_html=True)
 
 # Header
 st.markdown('''
@@ -292,13 +374,18 @@ st.markdown('</div>', unsafe_allow_html=True)
 if submitted and query.strip():
     with st.spinner("🔎 Searching knowledge base..."):
         try:
-            resp = requests.post(
-                f"{API_URL}/api/query", 
-                json={"query": query, "top_k": int(top_k)}, 
-                timeout=60
-            )
-            resp.raise_for_status()
-            data = resp.json()
+            data = cached_answer(query, int(top_k))
+            if data is None:
+                # Show the answer as it is generated; the history below renders the final version
+                result = {"sources": []}
+                live = st.empty()
+                with live.container():
+                    with st.chat_message("assistant"):
+                        streamed = st.write_stream(stream_answer(query, int(top_k), result))
+                live.empty()
+                data = {"answer": streamed, "sources": result["sources"]}
+                if streamed:
+                    store_answer(query, int(top_k), data)
             answer = data.get("answer")
             sources = data.get("sources", [])
         except Exception as e:
@@ -310,7 +397,7 @@ if submitted and query.strip():
             st.session_state.history.append({
                 "query": query, 
                 "answer": answer, 
-                "sources": sources
+                "sources": [history_source(src) for src in sources]
             })
 
 # Display chat history
@@ -338,18 +425,20 @@ if st.session_state.history:
             st.markdown('<div class="resources-header">📖 Related Documentation</div>', unsafe_allow_html=True)
             for i, src in enumerate(item["sources"], 1):
                 has_video = src.get("has_video", False)
+                # Entries saved before previews were introduced still carry the full content
+                preview = src.get("preview")
+                if preview is None:
+                    preview = preview_text(src.get("content", ""))
                 video_badge = '<span class="icon-badge video-badge">🎥 Video</span>' if has_video else ""
                 
                 video_link_html = ""
                 if has_video:
                     video_link_html = f'<div class="video-link">🎥 <a href="{src["url"]}" target="_blank" rel="noopener noreferrer">Watch Video on this page</a></div>'
                 
-                content_preview = src['content'][:180] + "..." if len(src['content']) > 180 else src['content']
-                
                 st.markdown(f"""
                 <div class='source-item'>
                     <strong style="color: #2c3e50;">📄 {i}. <a href='{src['url']}' target='_blank' rel='noopener noreferrer'>{src['title']}</a></strong>{video_badge}
-                    <p style='font-size: 0.95rem; color: #5a6c7d; margin-top: 0.6rem; line-height: 1.6;'>{content_preview}</p>
+                    <p style='font-size: 0.95rem; color: #5a6c7d; margin-top: 0.6rem; line-height: 1.6;'>{preview}</p>
                     {video_link_html}
                 </div>
                 """, unsafe_allow_html=True)
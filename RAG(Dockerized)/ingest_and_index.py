@@ -1,22 +1,32 @@
 import os
-import json
 import time
+import calendar
+import hashlib
 import logging
+import queue
 import re
-from typing import List, Dict, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 from urllib.parse import urljoin
-from html import unescape
+import numpy as np
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 # Azure/OpenAI imports
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SearchIndex, SimpleField, SearchableField, SearchField,
     SearchFieldDataType, VectorSearch, HnswAlgorithmConfiguration,
-    VectorSearchProfile
+    VectorSearchProfile, ScalarQuantizationCompression
 )
 from azure.search.documents import SearchClient
-from openai import AzureOpenAI
+from openai import AzureOpenAI, APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+from urllib3.util.retry import Retry
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # ============ CONFIG ============
 
@@ -33,9 +43,32 @@ AZURE_OPENAI_KEY = os.environ["AZURE_OPENAI_KEY"]
 EMBED_DEPLOYMENT = os.environ["AZURE_OPENAI_EMBED_DEPLOYMENT"]
 CHAT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_CHAT_DEPLOYMENT")
 STATE_FILE = os.environ.get("STATE_FILE", "/data/confluence_ingest_state.json")
+STATE_JOURNAL = os.environ.get("STATE_JOURNAL", STATE_FILE + ".log")
+STATE_COMPACT_BYTES = int(os.environ.get("STATE_COMPACT_BYTES", str(4 * 1024 * 1024)))
+# Set DEBUG_STATE=1 to pretty-print the state baseline for manual inspection
+DEBUG_STATE = os.environ.get("DEBUG_STATE") == "1"
+EMBED_CACHE_FILE = os.environ.get(
+    "EMBED_CACHE_FILE", os.path.join(os.path.dirname(STATE_FILE) or ".", "embedding_cache.npz")
+)
+# ~3 KB per 1536-dim entry, so the default is ~150 MB; a save briefly needs twice that
+EMBED_CACHE_MAX_ENTRIES = int(os.environ.get("EMBED_CACHE_MAX_ENTRIES", "50000"))
 CHUNK_MAX_CHARS = int(os.environ.get("CHUNK_MAX_CHARS", "3000"))
 CHUNK_OVERLAP_CHARS = int(os.environ.get("CHUNK_OVERLAP_CHARS", "400"))
 BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "32"))
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64"))
+EMBED_BATCH_MAX_CHARS = int(os.environ.get("EMBED_BATCH_MAX_CHARS", "200000"))
+FETCH_CONCURRENCY = int(os.environ.get("FETCH_CONCURRENCY", "16"))
+# Between full listings only pages modified since the last run are listed (deletions
+# are detected on the full listing); the lookback covers server timezone and run length
+FULL_LIST_INTERVAL_DAYS = float(os.environ.get("FULL_LIST_INTERVAL_DAYS", "7"))
+CQL_LOOKBACK_HOURS = int(os.environ.get("CQL_LOOKBACK_HOURS", "24"))
+LIST_PAGE_LIMIT = 250  # Confluence maximum page size for content listings
+DELETE_BATCH_SIZE = 1000
+DELETE_FILTER_PAGES = 500
+PIPELINE_QUEUE_SIZE = 64
+EMBED_FLUSH_SECONDS = 2.0
+SEARCH_API_VERSION = "2024-07-01"
+SEARCH_TIMEOUT = 60
 
 logging.basicConfig(
     level=logging.INFO,
@@ -51,45 +84,197 @@ client = AzureOpenAI(
     azure_endpoint=AZURE_OPENAI_ENDPOINT
 )
 
-def embed_texts(texts: List[str]) -> List[List[float]]:
+# Search clients are created once and reused for every batch
+search_credential = AzureKeyCredential(AZURE_SEARCH_KEY)
+index_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=search_credential)
+doc_client = SearchClient(
+    endpoint=AZURE_SEARCH_ENDPOINT,
+    index_name=AZURE_SEARCH_INDEX,
+    credential=search_credential
+)
+search_http = requests.Session()
+search_http.headers.update({"Content-Type": "application/json", "api-key": AZURE_SEARCH_KEY})
+# Uploads are idempotent, so throttled or unavailable responses are retried (honoring Retry-After)
+search_http.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=5, backoff_factor=1, status_forcelist=[429, 503], allowed_methods=None
+)))
+
+# Shared Confluence client; over HTTP/2 the concurrent page fetches share one connection
+confluence = httpx.Client(
+    http2=True,
+    auth=(CONFLUENCE_USER, CONFLUENCE_API_TOKEN),
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+    timeout=30.0,
+    follow_redirects=True  # requests followed redirects by default; httpx does not
+)
+
+@retry(
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    reraise=True
+)
+def _create_embeddings(texts: List[str]) -> List[List[float]]:
+    resp = client.embeddings.create(model=EMBED_DEPLOYMENT, input=texts)
+    return [d.embedding for d in resp.data]
+
+def embed_texts(texts: List[str]) -> List[Optional[List[float]]]:
+    """
+    Embed texts, retrying transient errors. A rejected batch is split to isolate the
+    bad inputs, which come back as None while every other text keeps its vector.
+    """
     try:
-        resp = client.embeddings.create(model=EMBED_DEPLOYMENT, input=texts)
-        return [d.embedding for d in resp.data]
-    except Exception as e:
-        logger.error(f"Embedding failed: {e}")
-        return [[0.0] * 1536 for _ in texts]
+        return _create_embeddings(texts)
+    except BadRequestError as e:
+        if len(texts) == 1:
+            logger.warning(f"Embedding input rejected ({len(texts[0])} chars): {e}")
+            return [None]
+        mid = len(texts) // 2
+        return embed_texts(texts[:mid]) + embed_texts(texts[mid:])
+
+def embedding_batches(texts: List[str]) -> List[range]:
+    """Split texts into consecutive batches bounded by item count and total characters"""
+    batches = []
+    start, chars = 0, 0
+    for i, text in enumerate(texts):
+        if i > start and (i - start >= EMBED_BATCH_SIZE or chars + len(text) > EMBED_BATCH_MAX_CHARS):
+            batches.append(range(start, i))
+            start, chars = i, 0
+        chars += len(text)
+    if start < len(texts):
+        batches.append(range(start, len(texts)))
+    return batches
 
 # ============ STATE HANDLING ============
 
+# State is a baseline snapshot (STATE_FILE) plus an append-only journal of
+# per-run page changes (STATE_JOURNAL), folded back into the baseline when large.
+
 def load_state() -> Dict[str, Any]:
+    state = {
+        "indexed_pages": {}, "retry_pages": {}, "last_run": None, "last_full_list": None,
+        "index_initialized": False
+    }
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as fh:
-            logger.info(f"Loaded ingest state from {STATE_FILE}")
-            return json.load(fh)
-    logger.info(f"No ingest state found, creating new state at: {STATE_FILE}")
-    return {"indexed_pages": {}, "last_run": None, "index_initialized": False}
-
-def save_state(state: Dict[str, Any]):
-    os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-    with open(STATE_FILE, "w", encoding="utf-8") as fh:
-        json.dump(state, fh, indent=2)
-    logger.info(f"State saved to {STATE_FILE}")
+        with open(STATE_FILE, "rb") as fh:
+            state = orjson.loads(fh.read())
+        logger.info(f"Loaded ingest state from {STATE_FILE}")
+    if os.path.exists(STATE_JOURNAL):
+        replayed = 0
+        with open(STATE_JOURNAL, "rb") as fh:
+            for line in fh:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # A run that crashed mid-write can leave a torn last line
+                    logger.warning(f"Skipping unreadable line in {STATE_JOURNAL}")
+                    continue
+                apply_state_changes(state, entry)
+                replayed += 1
+        logger.info(f"Replayed {replayed} runs from {STATE_JOURNAL}")
+    if not os.path.exists(STATE_FILE) and not os.path.exists(STATE_JOURNAL):
+        logger.info(f"No ingest state found, creating new state at: {STATE_FILE}")
+    return state
+
+def apply_state_changes(state: Dict[str, Any], entry: Dict[str, Any]):
+    for pid, ver in entry["changes"].items():
+        if ver is None:
+            state["indexed_pages"].pop(pid, None)
+        else:
+            state["indexed_pages"][pid] = ver
+    state["last_run"] = entry["ts"]
+    state["last_full_list"] = entry.get("full_list", state.get("last_full_list"))
+    state["retry_pages"] = entry.get("retry", state.get("retry_pages", {}))
+    state["index_initialized"] = True
+
+def save_state(state: Dict[str, Any], changes: Dict[str, Optional[int]]):
+    """Append this run's changes ({pid: version}, None for deleted) and retry set to the journal"""
+    os.makedirs(os.path.dirname(STATE_FILE) or ".", exist_ok=True)
+    entry = {
+        "ts": state["last_run"], "full_list": state.get("last_full_list"), "changes": changes,
+        "retry": state.get("retry_pages", {})
+    }
+    with open(STATE_JOURNAL, "ab") as fh:
+        fh.write(orjson.dumps(entry) + b"\n")
+    logger.info(f"Recorded {len(changes)} page changes in {STATE_JOURNAL}")
+    if os.path.getsize(STATE_JOURNAL) > STATE_COMPACT_BYTES:
+        compact_state(state)
+
+def compact_state(state: Dict[str, Any]):
+    """Write the full state as the new baseline and start an empty journal"""
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(orjson.dumps(state, option=orjson.OPT_INDENT_2 if DEBUG_STATE else None))
+    os.replace(tmp, STATE_FILE)
+    # Replaying the old journal over the new baseline is harmless, so a crash here is safe
+    open(STATE_JOURNAL, "wb").close()
+    logger.info(f"State compacted into {STATE_FILE}")
+
+# ============ EMBEDDING CACHE ============
+# Chunk hash -> vector, persisted as float16 between runs so unchanged chunks are not
+# re-embedded. Entries are kept least recently used first; the oldest are dropped on save.
+# The file records the deployment that produced the vectors, so a model change starts fresh.
+
+def load_embedding_cache(vector_dim: int) -> Dict[str, np.ndarray]:
+    if not os.path.exists(EMBED_CACHE_FILE):
+        return {}
+    with np.load(EMBED_CACHE_FILE) as data:
+        deployment = str(data["deployment"]) if "deployment" in data else None
+        vectors = data["vectors"]
+        stale = deployment != EMBED_DEPLOYMENT or vectors.shape[1] != vector_dim
+        if not stale:
+            cache = dict(zip(data["hashes"].tolist(), vectors))
+    if stale:
+        logger.info(
+            f"Discarding embedding cache from deployment {deployment} "
+            f"({vectors.shape[1]} dims); now {EMBED_DEPLOYMENT} ({vector_dim} dims)"
+        )
+        os.remove(EMBED_CACHE_FILE)
+        return {}
+    logger.info(f"Loaded {len(cache)} cached embeddings from {EMBED_CACHE_FILE}")
+    return cache
+
+def save_embedding_cache(cache: Dict[str, np.ndarray]):
+    """Save the most recently used entries; a failed save is logged, not raised"""
+    entries = list(cache.items())[-EMBED_CACHE_MAX_ENTRIES:]
+    if not entries:
+        return
+    hashes = np.array([h for h, _ in entries])
+    vectors = np.stack([v for _, v in entries]).astype(np.float16)
+    tmp = EMBED_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp, "wb") as fh:
+            np.savez(fh, hashes=hashes, vectors=vectors, deployment=np.array(EMBED_DEPLOYMENT))
+        os.replace(tmp, EMBED_CACHE_FILE)
+    except OSError as e:
+        logger.error(f"Could not save embedding cache to {EMBED_CACHE_FILE}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    logger.info(f"Saved {len(entries)} cached embeddings to {EMBED_CACHE_FILE}")
 
 # ============ AZURE SEARCH INDEX MGMT ============
 
-def ensure_index_exists():
-    idx_client = SearchIndexClient(endpoint=AZURE_SEARCH_ENDPOINT, credential=AzureKeyCredential(AZURE_SEARCH_KEY))
-    existing = [n for n in idx_client.list_index_names()]
+def ensure_index_exists() -> int:
+    """Create the index if it is missing; return the dimension of its vector field"""
+    existing = [n for n in index_client.list_index_names()]
     if AZURE_SEARCH_INDEX in existing:
         logger.info(f"Index exists: {AZURE_SEARCH_INDEX}")
-        return
+        index = index_client.get_index(AZURE_SEARCH_INDEX)
+        return next(f.vector_search_dimensions for f in index.fields if f.name == "vector")
 
-    sample_dim = len(embed_texts(["hello world"])[0])
+    sample_dim = len(_create_embeddings(["hello world"])[0])
     logger.info(f"Creating index with vector dim: {sample_dim}")
 
+    # Vectors are uploaded as float32 but stored as int8 (scalar quantization)
     vector_search = VectorSearch(
-        profiles=[VectorSearchProfile(name="my-vector-profile", algorithm_configuration_name="my-hnsw")],
-        algorithms=[HnswAlgorithmConfiguration(name="my-hnsw")]
+        profiles=[VectorSearchProfile(
+            name="my-vector-profile",
+            algorithm_configuration_name="my-hnsw",
+            compression_name="sq-8"
+        )],
+        algorithms=[HnswAlgorithmConfiguration(name="my-hnsw")],
+        compressions=[ScalarQuantizationCompression(compression_name="sq-8")]
     )
 
     fields = [
@@ -113,52 +298,63 @@ def ensure_index_exists():
     ]
 
     index = SearchIndex(name=AZURE_SEARCH_INDEX, fields=fields, vector_search=vector_search)
-    idx_client.create_index(index)
+    index_client.create_index(index)
     logger.info(f"Index created: {AZURE_SEARCH_INDEX}")
-
-def get_doc_client() -> SearchClient:
-    return SearchClient(
-        endpoint=AZURE_SEARCH_ENDPOINT,
-        index_name=AZURE_SEARCH_INDEX,
-        credential=AzureKeyCredential(AZURE_SEARCH_KEY)
-    )
-
-def upsert_documents(docs: List[Dict[str, Any]]):
+    return sample_dim
+
+def upsert_documents(docs: List[Dict[str, Any]]) -> List[str]:
+    """
+    Upload via the REST API so batches are encoded by orjson (vectors as float32).
+    Returns the keys of documents the service did not accept.
+    """
+    failed = []
     if not docs:
-        return
-    doc_client = get_doc_client()
+        return failed
+    url = f"{AZURE_SEARCH_ENDPOINT}/indexes/{AZURE_SEARCH_INDEX}/docs/index"
     for i in range(0, len(docs), BATCH_SIZE):
         batch = docs[i:i+BATCH_SIZE]
-        doc_client.upload_documents(documents=batch)
+        actions = [
+            {**doc, "@search.action": "upload", "vector": np.asarray(doc["vector"], dtype=np.float32)}
+            for doc in batch
+        ]
+        body = orjson.dumps({"value": actions}, option=orjson.OPT_SERIALIZE_NUMPY)
+        resp = search_http.post(
+            url, params={"api-version": SEARCH_API_VERSION}, data=body, timeout=SEARCH_TIMEOUT
+        )
+        resp.raise_for_status()
+        batch_failed = [r["key"] for r in orjson.loads(resp.content).get("value", []) if not r.get("status")]
+        if batch_failed:
+            logger.error(f"Failed to upload {len(batch_failed)} docs: {batch_failed}")
+            failed.extend(batch_failed)
         logger.info(f"Uploaded batch {i//BATCH_SIZE + 1} size {len(batch)}")
-
-def delete_docs_by_page_id(page_id: str):
-    doc_client = get_doc_client()
-    results = doc_client.search(search_text="*", filter=f"page_id eq '{page_id}'", select=["id"], top=1000)
-    ids = [r["id"] for r in results]
-    if not ids:
-        return
-    for i in range(0, len(ids), BATCH_SIZE):
-        batch_ids = ids[i:i+BATCH_SIZE]
-        actions = [{"@search.action": "delete", "id": id_} for id_ in batch_ids]
-        doc_client.index_documents(actions)
-        logger.info(f"Deleted {len(batch_ids)} docs for page {page_id}")
+    return failed
+
+def delete_docs_by_page_ids(page_ids: List[str]):
+    """Delete every chunk of the given pages, looking ids up with one filter per group of pages"""
+    ids = []
+    for i in range(0, len(page_ids), DELETE_FILTER_PAGES):
+        group = ",".join(page_ids[i:i+DELETE_FILTER_PAGES])
+        results = doc_client.search(
+            search_text="*",
+            filter=f"search.in(page_id, '{group}', ',')",
+            select=["id"],
+            top=100000
+        )
+        ids.extend(r["id"] for r in results)
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        batch_ids = ids[i:i+DELETE_BATCH_SIZE]
+        doc_client.delete_documents(documents=[{"id": id_} for id_ in batch_ids])
+        logger.info(f"Deleted {len(batch_ids)} docs")
 
 # ============ CONFLUENCE HELPERS ============
 
 def chunk_text(text: str, max_chars=CHUNK_MAX_CHARS, overlap=CHUNK_OVERLAP_CHARS) -> List[str]:
     if overlap >= max_chars:
         raise ValueError("CHUNK_OVERLAP_CHARS must be less than CHUNK_MAX_CHARS")
-    chunks = []
-    n = len(text)
-    i = 0
-    while i < n:
-        end = min(i + max_chars, n)
-        chunks.append(text[i:end])
-        i += max_chars - overlap
-    return [c for c in chunks if c]
-
-def list_space_pages(space_key: str, start=0, limit=50):
+    # Every start offset is < len(text), so no chunk is empty
+    return [text[i:i + max_chars] for i in range(0, len(text), max_chars - overlap)]
+
+def list_space_pages(space_key: str, start=0, limit=LIST_PAGE_LIMIT):
     """Fetch pages from Confluence space"""
     url = f"{CONFLUENCE_BASE}/rest/api/content"
     params = {
@@ -168,44 +364,108 @@ def list_space_pages(space_key: str, start=0, limit=50):
         "limit": limit,
         "expand": "version"
     }
-    resp = requests.get(url, params=params, auth=(CONFLUENCE_USER, CONFLUENCE_API_TOKEN))
+    resp = confluence.get(url, params=params)
     resp.raise_for_status()
-    return resp.json()
+    return orjson.loads(resp.content)
+
+def page_versions(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Keep only id and version number of listed pages"""
+    return [{"id": r["id"], "version": r["version"]["number"]} for r in results]
+
+def list_all_pages(space_key: str, limit=LIST_PAGE_LIMIT) -> List[Dict[str, Any]]:
+    """List id and version of every page in the space, requesting several offsets concurrently"""
+    first = list_space_pages(space_key, start=0, limit=limit)
+    # The server may cap the page size below what was asked for
+    limit = first.get("limit", limit)
+    pages = page_versions(first.get("results", []))
+    if len(pages) < limit:
+        return pages
+
+    def list_at(offset: int) -> List[Dict[str, Any]]:
+        return page_versions(list_space_pages(space_key, start=offset, limit=limit).get("results", []))
+
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        total = first.get("totalSize")
+        if total is not None:
+            for results in executor.map(list_at, range(limit, total, limit)):
+                pages.extend(results)
+            return pages
+
+        # No total in the response: request offsets in waves until a short page comes back
+        start = limit
+        while True:
+            wave = range(start, start + FETCH_CONCURRENCY * limit, limit)
+            for results in executor.map(list_at, wave):
+                pages.extend(results)
+                if len(results) < limit:
+                    return pages
+            start = wave.stop
+
+def list_changed_pages(space_key: str, since: str, limit=LIST_PAGE_LIMIT) -> List[Dict[str, Any]]:
+    """List id and version of pages modified at or after `since` ("YYYY-MM-DD HH:mm") with a CQL search"""
+    url = f"{CONFLUENCE_BASE}/rest/api/content/search"
+    cql = f'space="{space_key}" and type=page and lastmodified >= "{since}"'
+    pages, start = [], 0
+    while True:
+        params = {"cql": cql, "start": start, "limit": limit, "expand": "version"}
+        resp = confluence.get(url, params=params)
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)
+        limit = data.get("limit", limit)
+        results = data.get("results", [])
+        pages.extend(page_versions(results))
+        if len(results) < limit:
+            return pages
+        start += limit
 
 def fetch_page(page_id: str):
     """Fetch full page content"""
     url = f"{CONFLUENCE_BASE}/rest/api/content/{page_id}"
     params = {"expand": "body.storage,version,metadata.labels,_links.webui"}
-    resp = requests.get(url, params=params, auth=(CONFLUENCE_USER, CONFLUENCE_API_TOKEN))
+    resp = confluence.get(url, params=params)
     resp.raise_for_status()
-    return resp.json()
+    return orjson.loads(resp.content)
+
+def fetch_page_or_none(page_id: str):
+    """fetch_page for worker threads: log failures instead of raising"""
+    try:
+        return fetch_page(page_id)
+    except Exception as e:
+        logger.error(f"Error fetching page {page_id}: {e}")
+        return None
+
+# All video markers in one alternation, so a page is scanned once
+_VIDEO_RE = re.compile(
+    r'<ac:structured-macro[^>]*ac:name=["\'](?:multimedia|widget)["\']'
+    r'|<iframe[^>]*>'
+    r'|<video[^>]*>'
+    r'|<embed[^>]*type=["\']video'
+    r'|\.(?:mp4|webm|mov)["\']'
+    r'|youtube\.com'
+    r'|vimeo\.com'
+    r'|youtu\.be',
+    re.IGNORECASE
+)
+# Substrings at least one of which every _VIDEO_RE match contains
+_VIDEO_TOKENS = (
+    "multimedia", "widget", "<iframe", "<video", "<embed",
+    ".mp4", ".webm", ".mov", "youtu", "vimeo.com"
+)
 
 def convert_storage_to_text(storage_html: str) -> str:
-    """Convert Confluence storage format to plain text"""
-    text = re.sub(r'<[^>]+>', ' ', storage_html)
-    text = unescape(text)
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    """Convert Confluence storage format to plain text (entities decoded by the parser)"""
+    body = LexborHTMLParser(storage_html).body
+    if body is None:
+        return ""
+    return ' '.join(body.text(separator=' ').split())
 
 def has_video_content(storage_html: str) -> bool:
     """Detect if page contains video content"""
-    video_patterns = [
-        r'<ac:structured-macro[^>]*ac:name=["\']multimedia["\']',
-        r'<ac:structured-macro[^>]*ac:name=["\']widget["\']',
-        r'<iframe[^>]*>',
-        r'<video[^>]*>',
-        r'<embed[^>]*type=["\']video',
-        r'\.mp4["\']',
-        r'\.webm["\']',
-        r'\.mov["\']',
-        r'youtube\.com',
-        r'vimeo\.com',
-        r'youtu\.be'
-    ]
-    for pattern in video_patterns:
-        if re.search(pattern, storage_html, re.IGNORECASE):
-            return True
-    return False
+    # Plain substring scans are much cheaper than the regex and rule out most pages
+    lowered = storage_html.lower()
+    if not any(token in lowered for token in _VIDEO_TOKENS):
+        return False
+    return _VIDEO_RE.search(storage_html) is not None
 
 def fix_confluence_url(base_url: str, webui_path: str, space_key: str, page_id: str) -> str:
     base = base_url.rstrip('/')
@@ -223,99 +483,290 @@ def fix_confluence_url(base_url: str, webui_path: str, space_key: str, page_id:
         else:
             return f"{base}/wiki/spaces/{space_key}/pages/{page_id}"
 
+# ============ INGEST PIPELINE ============
+
+# Each stage reads from one queue and writes to the next; _DONE marks the end of the stream
+_DONE = object()
+
+def build_page_chunks(pid: str, page: Dict[str, Any]):
+    """Turn a fetched page into (doc metadata, chunks, chunk content hashes)"""
+    title = page.get("title", "")
+    links = page.get("_links", {})
+    webui = links.get("webui", "")
+    url = fix_confluence_url(CONFLUENCE_BASE, webui, SPACE_KEY, pid)
+    storage = page.get("body", {}).get("storage", {}).get("value", "")
+    text = convert_storage_to_text(storage)
+    has_video = has_video_content(storage)
+    chunks = chunk_text(text)
+    labels = []
+    if page.get("metadata", {}).get("labels"):
+        labels = [l.get("name") for l in page["metadata"]["labels"].get("results", [])]
+    last_modified = page.get("version", {}).get("when")
+    version_num = page.get("version", {}).get("number", 1)
+    hashes = [hashlib.blake2b(ch.encode("utf-8"), digest_size=16).hexdigest() for ch in chunks]
+    meta = {
+        "page_id": pid,
+        "title": title,
+        "url": url,
+        "last_modified": last_modified,
+        "version": version_num,
+        "space": SPACE_KEY,
+        "labels": labels,
+        "has_video": has_video
+    }
+    return meta, chunks, hashes
+
+def make_doc(meta: Dict[str, Any], idx: int, content: str, vector: np.ndarray) -> Dict[str, Any]:
+    """Build one index document; a fixed literal is cheaper than merging meta per chunk"""
+    pid = meta["page_id"]
+    return {
+        "id": f"{pid}_{idx}",
+        "page_id": pid,
+        "title": meta["title"],
+        "content": content,
+        "url": meta["url"],
+        "last_modified": meta["last_modified"],
+        "version": meta["version"],
+        "space": meta["space"],
+        "labels": meta["labels"],
+        "has_video": meta["has_video"],
+        "vector": vector
+    }
+
+def embed_missing(texts_by_hash: Dict[str, str], vec_by_hash: Dict[str, np.ndarray]):
+    """
+    Embed texts into vec_by_hash as float32 rows (~6 KB per 1536-dim vector instead of
+    ~37 KB as a list of Python floats); texts that cannot be embedded are logged and left out.
+    """
+    hashes = list(texts_by_hash)
+    for n, batch in enumerate(embedding_batches(list(texts_by_hash.values())), 1):
+        batch_hashes = hashes[batch.start:batch.stop]
+        try:
+            # Rejected chunks come back as None, so the rest of the batch is kept
+            embeddings = embed_texts([texts_by_hash[h] for h in batch_hashes])
+        except Exception as e:
+            logger.error(f"Embedding failed for batch {n}: {e}")
+            continue
+        for h, embedding in zip(batch_hashes, embeddings):
+            if embedding is None:
+                logger.error(f"Embedding rejected for chunk {h[:12]}")
+            else:
+                vec_by_hash[h] = np.asarray(embedding, dtype=np.float32)
+
+def fetch_stage(page_ids: List[str], out_q: queue.Queue):
+    """
+    Fetch pages concurrently, in order. At most 2 * FETCH_CONCURRENCY fetches are
+    pending at once and the next one is only submitted after a page is handed on,
+    so a full out_q stalls fetching instead of piling page bodies up in memory.
+    """
+    def hand_on(pid, future):
+        page = future.result()
+        if page is not None:
+            out_q.put((pid, page))
+
+    try:
+        with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+            in_flight = deque()
+            for pid in page_ids:
+                if len(in_flight) >= 2 * FETCH_CONCURRENCY:
+                    hand_on(*in_flight.popleft())
+                in_flight.append((pid, executor.submit(fetch_page_or_none, pid)))
+            while in_flight:
+                hand_on(*in_flight.popleft())
+    finally:
+        out_q.put(_DONE)
+
+def chunk_stage(in_q: queue.Queue, out_q: queue.Queue):
+    try:
+        while True:
+            item = in_q.get()
+            if item is _DONE:
+                break
+            pid, page = item
+            try:
+                page_chunks = build_page_chunks(pid, page)
+            except Exception as e:
+                logger.error(f"Error processing page {pid}: {e}")
+                continue
+            out_q.put(page_chunks)
+            logger.info(f"Processed page: {page_chunks[0]['title']} ({pid})")
+    finally:
+        out_q.put(_DONE)
+
+def embed_stage(in_q: queue.Queue, out_q: queue.Queue, vec_by_hash: Dict[str, np.ndarray]):
+    """
+    Collect chunks from incoming pages and embed them once a batch fills up or
+    EMBED_FLUSH_SECONDS pass, then emit (page id, docs) for every complete page.
+    Only chunks missing from the embedding cache are embedded; docs reference the
+    cached rows directly, which upsert_documents casts to float32.
+    """
+    pending_pages = []
+    pending_texts: Dict[str, str] = {}
+    pending_chars = 0
+    deadline = None
+    reused = embedded = 0
+    try:
+        while True:
+            finished = False
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = in_q.get(timeout=timeout)
+                if item is _DONE:
+                    finished = True
+                else:
+                    meta, chunks, hashes = item
+                    pending_pages.append(item)
+                    for h, ch in zip(hashes, chunks):
+                        if h in vec_by_hash:
+                            # Mark as recently used
+                            vec_by_hash[h] = vec_by_hash.pop(h)
+                            reused += 1
+                        elif h not in pending_texts:
+                            pending_texts[h] = ch
+                            pending_chars += len(ch)
+                    if deadline is None:
+                        deadline = time.monotonic() + EMBED_FLUSH_SECONDS
+            except queue.Empty:
+                pass
+
+            batch_full = len(pending_texts) >= EMBED_BATCH_SIZE or pending_chars >= EMBED_BATCH_MAX_CHARS
+            timed_out = deadline is not None and time.monotonic() >= deadline
+            if pending_pages and (finished or batch_full or timed_out):
+                embed_missing(pending_texts, vec_by_hash)
+                embedded += len(pending_texts)
+                for meta, chunks, hashes in pending_pages:
+                    pid = meta["page_id"]
+                    if any(h not in vec_by_hash for h in hashes):
+                        logger.error(f"Skipping page {pid}: some chunks could not be embedded")
+                        continue
+                    docs = [
+                        make_doc(meta, idx, ch, vec_by_hash[h])
+                        for idx, (ch, h) in enumerate(zip(chunks, hashes))
+                    ]
+                    out_q.put((pid, docs))
+                pending_pages, pending_texts, pending_chars, deadline = [], {}, 0, None
+            if finished:
+                break
+        logger.info(f"Chunks reused from embedding cache: {reused}, sent for embedding: {embedded}")
+    finally:
+        out_q.put(_DONE)
+
+def upload_stage(in_q: queue.Queue):
+    """Upload docs as batches fill; return (pages fully uploaded, number of docs uploaded)"""
+    processed, uploaded = [], 0
+    batch_pids, batch_docs = [], []
+
+    def flush():
+        nonlocal uploaded
+        try:
+            failed = set(upsert_documents(batch_docs))
+        except Exception as e:
+            logger.error(f"Upload failed for pages {batch_pids}: {e}")
+        else:
+            # Pages with any rejected chunk stay unprocessed so the next run retries them
+            failed_pids = {doc["page_id"] for doc in batch_docs if doc["id"] in failed}
+            processed.extend(pid for pid in batch_pids if pid not in failed_pids)
+            uploaded += len(batch_docs) - len(failed)
+        batch_pids.clear()
+        batch_docs.clear()
+
+    while True:
+        item = in_q.get()
+        if item is _DONE:
+            break
+        pid, docs = item
+        batch_pids.append(pid)
+        batch_docs.extend(docs)
+        if len(batch_docs) >= BATCH_SIZE:
+            flush()
+    if batch_pids:
+        flush()
+    return processed, uploaded
+
 # ============ MAIN INGEST LOGIC ============
 
+def _parse_ts(ts: str) -> float:
+    return calendar.timegm(time.strptime(ts, "%Y-%m-%dT%H:%M:%SZ"))
+
 def run_ingest():
     logger.info("Starting Confluence ingestion process")
     state = load_state()
-    ensure_index_exists()
+    vector_dim = ensure_index_exists()
     state["index_initialized"] = True
 
-    # Fetch all pages
-    pages = []
-    start = 0
-    limit = 50
-    while True:
-        resp = list_space_pages(SPACE_KEY, start=start, limit=limit)
-        results = resp.get("results", [])
-        if not results:
-            break
-        pages.extend(results)
-        if len(results) < limit:
-            break
-        start += limit
-
-    logger.info(f"Pages found: {len(pages)}")
-    current_versions = {p["id"]: p["version"]["number"] for p in pages}
-
-    # Detect deletions
+    now = time.time()
+    last_full = state.get("last_full_list")
+    full_list = (
+        not state.get("last_run") or not last_full
+        or now - _parse_ts(last_full) >= FULL_LIST_INTERVAL_DAYS * 86400
+    )
+    if full_list:
+        pages = list_all_pages(SPACE_KEY)
+        logger.info(f"Pages found: {len(pages)}")
+    else:
+        since = time.strftime(
+            "%Y-%m-%d %H:%M", time.gmtime(_parse_ts(state["last_run"]) - CQL_LOOKBACK_HOURS * 3600)
+        )
+        pages = list_changed_pages(SPACE_KEY, since)
+        logger.info(f"Pages modified since {since}: {len(pages)}")
+    current_versions = {p["id"]: p["version"] for p in pages}
+    # Pages that failed last time are retried even if the listing doesn't include them;
+    # a full listing is authoritative, so pages it no longer shows are dropped
+    retry_pages = state.get("retry_pages", {})
+    if retry_pages and not full_list:
+        logger.info(f"Retrying {len(retry_pages)} pages that failed previously")
+        current_versions = {**retry_pages, **current_versions}
+
+    # Page versions changed by this run (None = removed), appended to the state journal
+    changes: Dict[str, Optional[int]] = {}
+
+    # Detect deletions; only a full listing shows which pages are gone
     previously_indexed = state.get("indexed_pages", {})
-    deleted = [pid for pid in previously_indexed.keys() if pid not in current_versions]
+    deleted = list(previously_indexed.keys() - current_versions.keys()) if full_list else []
     if deleted:
         logger.info(f"Deleted pages detected: {deleted}")
+        delete_docs_by_page_ids(deleted)
         for pid in deleted:
-            delete_docs_by_page_id(pid)
             state["indexed_pages"].pop(pid, None)
+            changes[pid] = None
 
     # Detect new or changed pages
-    to_update = []
-    for p in pages:
-        pid = p["id"]
-        ver = p["version"]["number"]
-        if pid not in previously_indexed or previously_indexed.get(pid) != ver:
-            to_update.append(pid)
+    to_update = [pid for pid, ver in current_versions.items() if previously_indexed.get(pid) != ver]
 
     logger.info(f"Pages to update (new/changed): {len(to_update)}")
-    all_docs = []
-    for pid in to_update:
-        try:
-            page = fetch_page(pid)
-            title = page.get("title", "")
-            links = page.get("_links", {})
-            webui = links.get("webui", "")
-            url = fix_confluence_url(CONFLUENCE_BASE, webui, SPACE_KEY, pid)
-            storage = page.get("body", {}).get("storage", {}).get("value", "")
-            text = convert_storage_to_text(storage)
-            has_video = has_video_content(storage)
-            chunks = chunk_text(text)
-            labels = []
-            if page.get("metadata", {}).get("labels"):
-                labels = [l.get("name") for l in page["metadata"]["labels"].get("results", [])]
-            last_modified = page.get("version", {}).get("when")
-            version_num = page.get("version", {}).get("number", 1)
-            for i in range(0, len(chunks), BATCH_SIZE):
-                batch_chunks = chunks[i:i+BATCH_SIZE]
-                embeddings = embed_texts(batch_chunks)
-                for j, ch in enumerate(batch_chunks):
-                    idx = i + j
-                    doc = {
-                        "id": f"{pid}_{idx}",
-                        "page_id": pid,
-                        "title": title,
-                        "content": ch,
-                        "url": url,
-                        "last_modified": last_modified,
-                        "version": version_num,
-                        "space": SPACE_KEY,
-                        "labels": labels,
-                        "has_video": has_video,
-                        "vector": embeddings[j]
-                    }
-                    all_docs.append(doc)
-            logger.info(f"Processed page: {title} ({pid})")
-        except Exception as e:
-            logger.error(f"Error processing page {pid}: {e}")
-            continue
-
-    if all_docs:
-        upsert_documents(all_docs)
-
-    for pid in to_update:
+    # Fetch, chunk, embed and upload run concurrently, linked by bounded queues
+    fetched_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    chunked_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    embedded_q = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    embedding_cache = load_embedding_cache(vector_dim)
+    with ThreadPoolExecutor(max_workers=3) as stages:
+        futures = [
+            stages.submit(fetch_stage, to_update, fetched_q),
+            stages.submit(chunk_stage, fetched_q, chunked_q),
+            stages.submit(embed_stage, chunked_q, embedded_q, embedding_cache)
+        ]
+        processed, uploaded = upload_stage(embedded_q)
+        for f in futures:
+            f.result()
+
+    # Failed pages stay out of state so the next run retries them
+    for pid in processed:
         state["indexed_pages"][pid] = current_versions.get(pid)
+        changes[pid] = current_versions.get(pid)
 
     state["last_run"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    save_state(state)
-    logger.info(f"Ingestion complete. Total docs indexed: {len(all_docs)}")
+    # An unchanged page won't show up in the next CQL listing, so failed pages are
+    # remembered with the version they were listed at and retried on their own
+    done = set(processed)
+    state["retry_pages"] = {pid: current_versions[pid] for pid in to_update if pid not in done}
+    if state["retry_pages"]:
+        logger.warning(f"{len(state['retry_pages'])} pages failed and will be retried next run")
+    if full_list:
+        state["last_full_list"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+    save_state(state, changes)
+    # Saved after the state, so a cache that cannot be written never costs the run its progress
+    save_embedding_cache(embedding_cache)
+    logger.info(f"Ingestion complete. Total docs indexed: {uploaded}")
 
 if __name__ == "__main__":
     try: